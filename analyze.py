@@ -1,18 +1,43 @@
 #!/usr/bin/env python3
 
 import argparse
+import functools
+import http.client
 import ipaddress
 import json
+import os
+import queue
+import re
+import subprocess
 import sys
+from collections import Counter, defaultdict
+from concurrent.futures import ThreadPoolExecutor
 from dataclasses import dataclass
 from datetime import datetime, timedelta, time, timezone
 from enum import Enum
-import urllib.request
+from pathlib import Path
 
-from systemd import journal
+try:
+    from systemd import journal
+except ImportError:
+    journal = None
 from typing import Iterable
 
 DATETIME_FORMAT = "%Y-%m-%dT%H:%M:%S"
+UNIX_EPOCH = datetime(1970, 1, 1, tzinfo=timezone.utc)
+# e.g. "2025-08-03T18:30:18.978Z CLOSE host=::ffff:1.2.3.4 port=22 fd=4 time=20.006 bytes=12"
+MESSAGE_PATTERN = re.compile(rb"\S+ (\S+) host=(\S+) port=\S+ fd=(\d+) (?:time=([0-9.]+))?")
+IPINFO_HOST = "ipinfo.io"
+IPINFO_BATCH_SIZE = 100
+IPINFO_TIMEOUT = 5
+IPINFO_MAX_WORKERS = 20
+GEOIP_CACHE_FILE = (
+    Path(os.environ.get("XDG_CACHE_HOME") or Path.home() / ".cache") / "endlessh-journal-analyzer" / "geoip.json"
+)
+GEOIP_CACHE_TTL = timedelta(days=30)
+
+# idle keep-alive connections to ipinfo.io, reused across lookups
+_IPINFO_POOL: queue.SimpleQueue[http.client.HTTPSConnection] = queue.SimpleQueue()
 
 
 class ConnectionType(Enum):
@@ -21,7 +46,13 @@ class ConnectionType(Enum):
     CLOSE = 2
 
 
-@dataclass
+@functools.lru_cache(maxsize=8192)
+def parse_ip(ip_bytes: bytes) -> ipaddress.IPv4Address | ipaddress.IPv6Address:
+    """Parse an IP address, reusing the same object for recurring attackers"""
+    return ipaddress.ip_address(ip_bytes.decode())
+
+
+@dataclass(slots=True)
 class ConnectionEvent:
     time: datetime
     type: ConnectionType
@@ -34,54 +65,28 @@ class ConnectionEvent:
         return (self.ip, self.fd)
 
     @classmethod
-    def from_journal(cls, msg: str):
-        """Create dataclass instance from journal message"""
-        split = msg.split(" ")
-        if len(split) < 6:
-            return
-
-        if not split[2].startswith("host="):
+    def from_journal(cls, ts: datetime, msg: bytes):
+        """Create dataclass instance from UTC journal timestamp and raw message"""
+        # endlessh's own timestamp in the first field is skipped, the journal timestamp is used instead
+        if not (fields := MESSAGE_PATTERN.match(msg)):
             return
 
-        ip = ipaddress.ip_address(split[2].split("=")[1])
-        fd = int(split[4].split("=")[1])
+        kind, host, fd, elapsed = fields.groups()
+        ip = parse_ip(host)
+        fd = int(fd)
         duration = None
 
-        match split[1]:
-            case "ACCEPT":
+        match kind:
+            case b"ACCEPT":
                 type = ConnectionType.ACCEPT
-            case "CLOSE":
+            case b"CLOSE":
                 type = ConnectionType.CLOSE
-                duration = float(split[5].split("=")[1])
+                duration = float(elapsed)
             case _:
-                print(f"Unmatched connection type {split[1]}")
+                print(f"Unmatched connection type {kind.decode(errors='replace')}")
                 type = ConnectionType.UNKNOWN
 
-        time = datetime.strptime(split[0], "%Y-%m-%dT%H:%M:%S.%fZ")
-        time = time.replace(tzinfo=timezone.utc)
-
-        return cls(time=time, type=type, ip=ip, fd=fd, duration=duration)
-
-
-@dataclass
-class Connection:
-    events: list[ConnectionEvent]
-
-    def add_event(self, event: ConnectionEvent):
-        if not self.events:
-            self.events = [event]
-        else:
-            if self.events[-1].ip != event.ip:
-                raise ValueError("Invalid IP for connection!")
-            if self.events[-1].fd != event.fd:
-                raise ValueError("Invalid fd for connection!")
-            self.events.append(event)
-
-    def get_ip(self):
-        return self.events[0].ip
-
-    def get_duration(self) -> float | None:
-        return self.events[-1].duration
+        return cls(time=ts, type=type, ip=ip, fd=fd, duration=duration)
 
 
 def get_today_timestamps():
@@ -111,7 +116,22 @@ def parse_arguments():
         "-u", "--unit", type=str, help="The systemd unit name (default: endlessh.service)", default="endlessh.service"
     )
     parser.add_argument("-U", "--user", action="store_true", help="Execute for current user instead of system")
+    parser.add_argument(
+        "-b",
+        "--backend",
+        choices=["journal", "subproc"],
+        help="Read the log using python-systemd or by running journalctl "
+        "(default: journal if python-systemd is installed, subproc otherwise)",
+        default="journal" if journal else "subproc",
+    )
     parser.add_argument("-g", "--geo-ip", action="store_true", help="Look up the geo ip information")
+    parser.add_argument(
+        "-t",
+        "--token",
+        type=str,
+        help="ipinfo.io API token, enables batched geo ip lookups (default: $IPINFO_TOKEN)",
+        default=os.environ.get("IPINFO_TOKEN"),
+    )
 
     # time range arguments/presets
     parser.add_argument("--start", type=str, help="Start datetime (e.g., 2025-08-01T00:00:00)")
@@ -122,6 +142,9 @@ def parse_arguments():
 
     args = parser.parse_args()
 
+    if args.backend == "journal" and not journal:
+        parser.error("The journal backend requires python-systemd to be installed")
+
     # Validate start/end or presets are specified and mutually exclusive
     if args.today or args.yesterday:
         if args.start is not None or args.end is not None:
@@ -145,7 +168,7 @@ def resolve_time_range(args):
         return int(start_dt.timestamp()), int(end_dt.timestamp())
 
 
-def yield_journal_messages(start_time: int, end_time: int, unit: str, user: bool) -> Iterable[str]:
+def yield_journal_messages(start_time: int, end_time: int, unit: str, user: bool) -> Iterable[tuple[datetime, bytes]]:
     if user:
         j = journal.Reader(journal.CURRENT_USER)
         j.add_match(_SYSTEMD_USER_UNIT=unit)
@@ -153,44 +176,172 @@ def yield_journal_messages(start_time: int, end_time: int, unit: str, user: bool
         j = journal.Reader()
         j.add_match(_SYSTEMD_UNIT=unit)
 
-    j.seek_realtime(start_time)
-    j.get_next()  # Move to the first entry on/after start_time
-
-    while True:
-        entry = j.get_next()
-        if not entry:
+    # python-systemd works with naive local datetimes, integers would be interpreted as microseconds.
+    # Entries within the last second are still included, just like end_time itself.
+    start_dt = datetime.fromtimestamp(start_time)
+    end_dt = datetime.fromtimestamp(end_time + 1)
+
+    # find the last entry in range upfront, so iterating can stop there without checking every timestamp
+    j.seek_realtime(end_dt)
+    last_entry = j.get_previous()
+    if not last_entry or last_entry["__REALTIME_TIMESTAMP"] < start_dt:
+        return
+    end_cursor = last_entry["__CURSOR"]
+
+    # Only read the two fields that are needed from the underlying C reader,
+    # get_next() would copy and convert every field of every entry.
+    # The message is kept as bytes, it is only ASCII and doesn't need to be decoded.
+    j.seek_realtime(start_dt)
+    while j._next():
+        realtime = UNIX_EPOCH + timedelta(microseconds=j._get_realtime())
+        try:
+            msg = j._get("MESSAGE")
+        except KeyError:
+            msg = b"<no message>"
+        yield realtime, msg
+
+        if j.test_cursor(end_cursor):
             break
-        realtime = entry["__REALTIME_TIMESTAMP"]  # This is a datetime.datetime object
 
-        if int(realtime.timestamp()) > end_time:
-            break
 
-        yield entry.get("MESSAGE", "<no message>")
+def yield_journalctl_messages(
+    start_time: int, end_time: int, unit: str, user: bool
+) -> Iterable[tuple[datetime, bytes]]:
+    """Read the log from a journalctl process, which runs in parallel to the parsing"""
+    cmd = ["journalctl", "--unit", unit, "--since", f"@{start_time}", "--until", f"@{end_time + 1}"]
+    cmd += ["--output", "short-unix", "--no-pager", "--quiet"]
+    if user:
+        cmd.append("--user")
+
+    with subprocess.Popen(cmd, stdout=subprocess.PIPE, bufsize=1 << 20) as proc:
+        for line in proc.stdout:
+            # e.g. "1754245818.978123 hostname endlessh[1234]: <message>"
+            ts, _, rest = line.partition(b" ")
+            seconds, _, micros = ts.partition(b".")
+            if not seconds.isdigit():
+                continue  # e.g. "-- Boot ... --" markers
+            realtime = UNIX_EPOCH + timedelta(seconds=int(seconds), microseconds=int(micros or 0))
+            yield realtime, rest.partition(b": ")[2].rstrip(b"\n")
+
+    if proc.returncode:
+        raise RuntimeError(f"journalctl exited with status {proc.returncode}")
 
 
+@functools.lru_cache(maxsize=1024)
 def human_readable_seconds(seconds: int) -> str:
     if seconds < 60:
         return f"{seconds} second(s)"
     elif seconds < 3600:
-        minutes = seconds // 60
-        rem = seconds % 60
+        minutes, rem = divmod(seconds, 60)
         return f"{minutes} minute(s), {rem} second(s)"
     else:
-        hours = seconds // 3600
-        rem = seconds % 3600
-        minutes = rem // 60
-        rem_seconds = rem % 60
+        hours, rem = divmod(seconds, 3600)
+        minutes, rem_seconds = divmod(rem, 60)
         return f"{hours} hour(s), {minutes} minute(s), {rem_seconds} second(s)"
 
 
-def get_geoip_info(ip: ipaddress.IPv4Address | ipaddress.IPv6Address) -> dict:
+def normalize_ip(ip: ipaddress.IPv4Address | ipaddress.IPv6Address) -> str:
     ip_str = str(ip)
     if "." in ip_str and ":" in ip_str:
-        # convert ipv4-mapped-ipv6-address to regular v6
+        # convert ipv4-mapped-ipv6-address to regular v4
         ip_str = ip_str.split(":")[-1]
+    return ip_str
+
+
+def ipinfo_request(method: str, url: str, body: bytes | None = None) -> dict:
+    """Send a request to ipinfo.io, reusing a pooled keep-alive connection"""
+    headers = {"User-Agent": "endlessh-journal-analyzer", "Accept": "application/json"}
+    if body is not None:
+        headers["Content-Type"] = "application/json"
+
+    for attempt in range(2):
+        try:
+            conn = _IPINFO_POOL.get_nowait()
+        except queue.Empty:
+            conn = http.client.HTTPSConnection(IPINFO_HOST, timeout=IPINFO_TIMEOUT)
+
+        try:
+            conn.request(method, url, body=body, headers=headers)
+            response = conn.getresponse()
+            data = response.read()
+        except (http.client.RemoteDisconnected, ConnectionError):
+            # the server may have closed an idle connection, retry once on a fresh one
+            conn.close()
+            if attempt:
+                raise
+            continue
+
+        _IPINFO_POOL.put(conn)
+        if response.status != 200:
+            raise http.client.HTTPException(f"ipinfo.io returned {response.status} {response.reason}")
+        return json.loads(data.decode())
 
-    with urllib.request.urlopen(f"https://ipinfo.io/{ip_str}") as response:
-        return json.loads(response.read().decode())
+
+def close_ipinfo_connections():
+    while True:
+        try:
+            _IPINFO_POOL.get_nowait().close()
+        except queue.Empty:
+            break
+
+
+def get_geoip_info(ip_str: str) -> dict:
+    return ipinfo_request("GET", f"/{ip_str}")
+
+
+def get_geoip_batch(ips: list[str], token: str) -> dict:
+    """Look up multiple IPs at once using the ipinfo.io batch endpoint"""
+    result = {}
+    for i in range(0, len(ips), IPINFO_BATCH_SIZE):
+        body = json.dumps(ips[i : i + IPINFO_BATCH_SIZE]).encode()
+        result.update(ipinfo_request("POST", f"/batch?token={token}", body))
+    return result
+
+
+def load_geoip_cache() -> dict:
+    try:
+        with open(GEOIP_CACHE_FILE) as f:
+            cache = json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+    # drop expired entries
+    min_fetched = (datetime.now(timezone.utc) - GEOIP_CACHE_TTL).timestamp()
+    return {ip: entry for ip, entry in cache.items() if entry.get("fetched", 0) >= min_fetched}
+
+
+def save_geoip_cache(cache: dict):
+    try:
+        GEOIP_CACHE_FILE.parent.mkdir(parents=True, exist_ok=True)
+        tmp_file = GEOIP_CACHE_FILE.with_suffix(".tmp")
+        with open(tmp_file, "w") as f:
+            json.dump(cache, f)
+        os.replace(tmp_file, GEOIP_CACHE_FILE)
+    except OSError as e:
+        print(f"Failed to write geo ip cache {GEOIP_CACHE_FILE}: {e}", file=sys.stderr)
+
+
+def lookup_geoip(ips: list[str], token: str | None) -> dict:
+    """Look up geo ip information, using the on-disk cache where possible"""
+    cache = load_geoip_cache()
+    missing = [ip for ip in ips if ip not in cache]
+
+    if missing:
+        try:
+            if token:
+                infos = get_geoip_batch(missing, token)
+            else:
+                with ThreadPoolExecutor(max_workers=IPINFO_MAX_WORKERS) as executor:
+                    infos = dict(zip(missing, executor.map(get_geoip_info, missing)))
+        finally:
+            close_ipinfo_connections()
+
+        fetched = datetime.now(timezone.utc).timestamp()
+        for ip, info in infos.items():
+            cache[ip] = {"fetched": fetched, "info": info}
+        save_geoip_cache(cache)
+
+    return {ip: cache[ip]["info"] for ip in ips if ip in cache}
 
 
 def main():
@@ -201,52 +352,56 @@ def main():
         print(f"Error: {e}", file=sys.stderr)
         sys.exit(1)
 
-    closed_connections = []
     open_connections = {}
-    for msg in yield_journal_messages(start_time, end_time, args.unit, args.user):
-        if not (event := ConnectionEvent.from_journal(msg)):
+    connection_counts = Counter()
+    connection_durations = defaultdict(float)
+    if args.backend == "subproc":
+        messages = yield_journalctl_messages(start_time, end_time, args.unit, args.user)
+    else:
+        messages = yield_journal_messages(start_time, end_time, args.unit, args.user)
+
+    for ts, msg in messages:
+        if not (event := ConnectionEvent.from_journal(ts, msg)):
             continue
+        key = event.conn()
         if event.type == ConnectionType.ACCEPT:
-            if conn := open_connections.get(event.conn()):
-                conn.add_event(event)
-            else:
-                conn = Connection([event])
-                open_connections[event.conn()] = conn
+            # only the ACCEPT event is kept until the connection is closed
+            open_connections.setdefault(key, event)
 
         if event.type == ConnectionType.CLOSE:
-            if not (connection := open_connections[event.conn()]):
+            if open_connections.pop(key, None) is None:
                 print(f"Closing leftover connection: ip={event.ip}, fd={event.fd}", file=sys.stderr)
             else:
-                connection.add_event(event)
-                closed_connections.append(connection)
-                del open_connections[event.conn()]
+                connection_counts[event.ip] += 1
+                connection_durations[event.ip] += event.duration
 
+    # collect the report and write it at once instead of printing line by line
+    lines = []
     if open_connections:
-        print("")
-        print("Currently open connections:")
-    for conn in open_connections.values():
-        print(f"\t{conn.get_ip()} since {conn.events[0].time}")
+        lines.append("")
+        lines.append("Currently open connections:")
+    for accept in open_connections.values():
+        lines.append(f"\t{accept.ip} since {accept.time}")
 
-    print("")
-    print(f"Closed connections: {len(closed_connections)}")
+    lines.append("")
+    lines.append(f"Closed connections: {connection_counts.total()}")
 
-    grouped_connections = {}
-    for conn in closed_connections:
-        if conn.get_ip() in grouped_connections:
-            grouped_connections[conn.get_ip()].append(conn)
-        else:
-            grouped_connections[conn.get_ip()] = [conn]
+    # order by ip with most connections
+    ordered = connection_counts.most_common()
+
+    geoip_infos = {}
+    if args.geo_ip:
+        ips = list(dict.fromkeys(normalize_ip(ip) for ip, _ in ordered))
+        geoip_infos = lookup_geoip(ips, args.token)
 
     total_time = 0
-    # order by ip with most connections
-    for conns in reversed(sorted(grouped_connections.values(), key=len)):
-        ip = conns[0].get_ip()
-        duration = sum(conn.get_duration() for conn in conns)
+    for ip, count in ordered:
+        duration = connection_durations[ip]
         total_time += duration
 
         msg = f"{ip}"
         if args.geo_ip:
-            geoip_info = get_geoip_info(ip)
+            geoip_info = geoip_infos.get(normalize_ip(ip), {})
             if "hostname" in geoip_info:
                 msg += f" {geoip_info['hostname']}"
             if "org" in geoip_info:
@@ -254,10 +409,11 @@ def main():
             if "region" in geoip_info:
                 msg += f" ({geoip_info['region']}, {geoip_info.get('country', '?')})"
 
-        print(f"{msg}: {len(conns)} connections, spent {human_readable_seconds(int(duration))}")
+        lines.append(f"{msg}: {count} connections, spent {human_readable_seconds(int(duration))}")
 
-    print("")
-    print(f"Total time: {human_readable_seconds(int(total_time))}")
+    lines.append("")
+    lines.append(f"Total time: {human_readable_seconds(int(total_time))}")
+    sys.stdout.write("\n".join(lines) + "\n")
 
 if __name__ == "__main__":
     main()